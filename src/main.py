@@ -5,6 +5,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, send_from_directory, jsonify, request
 from flask_cors import CORS
+from sqlalchemy.pool import QueuePool
 from src.models.user import db
 from src.routes.user import user_bp
 from src.routes.loyalty import loyalty_bp
@@ -22,9 +23,25 @@ app.register_blueprint(loyalty_bp, url_prefix='/api')
 # Configuração do banco de dados
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool de conexões explícito: reusa conexões sob concorrência em vez de
+# abrir/fechar a cada requisição (pre_ping desligado para não custar um
+# round-trip extra por checkout)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 10,
+    'max_overflow': 5,
+    'pool_recycle': 60,
+    'pool_pre_ping': False,
+}
 db.init_app(app)
 with app.app_context():
     db.create_all()
+    # create_all() não altera tabelas que já existem, então os índices
+    # declarados em __table_args__ precisam ser criados explicitamente para
+    # bancos antigos como o app.db que acompanha o repositório
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
 
 # Rota para servir o frontend React
 @app.route('/', defaults={'path': ''})
@@ -1,11 +1,42 @@
 from flask_sqlalchemy import SQLAlchemy
+from bisect import bisect_right
 from datetime import datetime
+from functools import cached_property
 from src.models.user import db
 import re
+import string
+import time
+
+# Tabela de tradução que apaga tudo que não for dígito; str.translate roda em C
+# puro e é bem mais rápido que re.sub(r'\D', ...) nas strings curtas de CPF/telefone.
+# A tabela só cobre ASCII, então entradas com pontuação fora do Latin básico
+# (travessões, espaços tipográficos etc.) caem no regex pré-compilado
+_DIGIT_TABLE = str.maketrans('', '', ''.join(chr(c) for c in range(128) if chr(c) not in '0123456789'))
+_NONDIGIT = re.compile(r'\D')
+
+def strip_non_digits(value):
+    """Remove todos os caracteres que não sejam dígitos"""
+    if value.isascii():
+        return value.translate(_DIGIT_TABLE)
+    return _NONDIGIT.sub('', value)
+
+# Chaves do payload de Customer.to_dict, internadas uma única vez: montar o
+# dict com dict(zip(...)) reusa os hashes das chaves em vez de recalculá-los
+# a cada cliente serializado
+_CUSTOMER_KEYS = (
+    'id', 'full_name', 'cpf', 'cpf_raw', 'phone', 'phone_raw', 'email',
+    'points', 'total_spent', 'level', 'discount', 'points_to_next_level',
+    'created_at', 'last_visit', 'active', 'benefit_type'
+)
 
 class Customer(db.Model):
     __tablename__ = 'customers'
-    
+    __table_args__ = (
+        # Quase todos os endpoints filtram por active; /stats agrupa por nível
+        db.Index('ix_customers_active', 'active'),
+        db.Index('ix_customers_level_active', 'level', 'active'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     full_name = db.Column(db.String(150), nullable=False)
     cpf = db.Column(db.String(14), unique=True, nullable=False)  # CPF único como identificador
@@ -23,36 +54,29 @@ class Customer(db.Model):
     
     def format_cpf(self):
         """Formata CPF para exibição (XXX.XXX.XXX-XX)"""
-        cpf = re.sub(r'\D', '', self.cpf)
+        cpf = strip_non_digits(self.cpf)
         if len(cpf) == 11:
             return f"{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}"
         return self.cpf
     
     def format_phone(self):
         """Formata telefone para exibição"""
-        phone = re.sub(r'\D', '', self.phone)
+        phone = strip_non_digits(self.phone)
         if len(phone) == 11:
             return f"({phone[:2]}) {phone[2:7]}-{phone[7:]}"
         elif len(phone) == 10:
             return f"({phone[:2]}) {phone[2:6]}-{phone[6:]}"
         return self.phone
     
-    def get_level(self):
+    def get_level(self, _config=None):
         """Calcula o nível baseado nos pontos usando configurações do sistema"""
-        config = LoyaltyConfig.get_current_config()
-        if self.points >= config.diamond_threshold:
-            return 'Diamante'
-        elif self.points >= config.gold_threshold:
-            return 'Ouro'
-        elif self.points >= config.silver_threshold:
-            return 'Prata'
-        else:
-            return 'Bronze'
-    
-    def get_discount(self):
+        config = _config or LoyaltyConfig.get_current_config()
+        return config.level_for_points(self.points)
+    
+    def get_discount(self, _config=None):
         """Retorna o desconto baseado no nível usando configurações do sistema"""
-        config = LoyaltyConfig.get_current_config()
-        level = self.get_level()
+        config = _config or LoyaltyConfig.get_current_config()
+        level = self.get_level(_config=config)
         discounts = {
             'Bronze': config.bronze_discount,
             'Prata': config.silver_discount,
@@ -61,76 +85,72 @@ class Customer(db.Model):
         }
         return discounts.get(level, config.bronze_discount)
     
-    def points_to_next_level(self):
+    def points_to_next_level(self, _config=None):
         """Calcula quantos pontos faltam para o próximo nível"""
-        config = LoyaltyConfig.get_current_config()
-        if self.points < config.silver_threshold:
-            return config.silver_threshold - self.points
-        elif self.points < config.gold_threshold:
-            return config.gold_threshold - self.points
-        elif self.points < config.diamond_threshold:
-            return config.diamond_threshold - self.points
-        else:
-            return 0
-    
-    def add_points(self, amount_spent):
+        config = _config or LoyaltyConfig.get_current_config()
+        return config.points_to_next(self.points)
+    
+    def add_points(self, amount_spent, _config=None):
         """Adiciona pontos baseado no valor gasto usando configurações do sistema"""
-        config = LoyaltyConfig.get_current_config()
-        
-        if config.benefit_type == 'points':
-            points_to_add = int(amount_spent // config.points_per_real)
-            self.points += points_to_add
-        elif config.benefit_type == 'cashback':
-            # Para cashback, ainda mantemos pontos para níveis, mas calculamos o valor de volta
-            points_to_add = int(amount_spent // config.points_per_real)
-            self.points += points_to_add
-        else:  # discount
-            # Para desconto, pontos são apenas para níveis
-            points_to_add = int(amount_spent // config.points_per_real)
-            self.points += points_to_add
-        
+        config = _config or LoyaltyConfig.get_current_config()
+
+        # Todos os tipos de benefício acumulam pontos da mesma forma (para
+        # cashback/desconto eles servem apenas para os níveis)
+        points_to_add = int(amount_spent // config.points_per_real)
+        self.points += points_to_add
+
         self.total_spent += amount_spent
-        self.level = self.get_level()
+        self.level = self.get_level(_config=config)
         self.last_visit = datetime.utcnow()
         return points_to_add
-    
-    def calculate_benefit_value(self, amount_spent):
+
+    def calculate_benefit_value(self, amount_spent, _config=None):
         """Calcula o valor do benefício baseado no tipo configurado"""
-        config = LoyaltyConfig.get_current_config()
-        
+        config = _config or LoyaltyConfig.get_current_config()
+
         if config.benefit_type == 'discount':
-            discount_percent = self.get_discount()
+            discount_percent = self.get_discount(_config=config)
             return amount_spent * (discount_percent / 100)
         elif config.benefit_type == 'cashback':
-            cashback_percent = self.get_discount()  # Usa a mesma lógica de níveis
+            cashback_percent = self.get_discount(_config=config)  # Usa a mesma lógica de níveis
             return amount_spent * (cashback_percent / 100)
         else:  # points
-            return self.add_points(amount_spent)
-    
-    def to_dict(self):
-        config = LoyaltyConfig.get_current_config()
-        return {
-            'id': self.id,
-            'full_name': self.full_name,
-            'cpf': self.format_cpf(),
-            'cpf_raw': self.cpf,
-            'phone': self.format_phone(),
-            'phone_raw': self.phone,
-            'email': self.email,
-            'points': self.points,
-            'total_spent': self.total_spent,
-            'level': self.level,
-            'discount': self.get_discount(),
-            'points_to_next_level': self.points_to_next_level(),
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'last_visit': self.last_visit.isoformat() if self.last_visit else None,
-            'active': self.active,
-            'benefit_type': config.benefit_type
-        }
+            return self.add_points(amount_spent, _config=config)
+
+    @cached_property
+    def created_at_iso(self):
+        """created_at em ISO-8601; imutável após o cadastro, formatado uma vez"""
+        return self.created_at.isoformat() if self.created_at else None
+
+    def to_dict(self, _config=None):
+        config = _config or LoyaltyConfig.get_current_config()
+        values = (
+            self.id,
+            self.full_name,
+            self.format_cpf(),
+            self.cpf,
+            self.format_phone(),
+            self.phone,
+            self.email,
+            self.points,
+            self.total_spent,
+            self.level,
+            self.get_discount(_config=config),
+            self.points_to_next_level(_config=config),
+            self.created_at_iso,
+            self.last_visit.isoformat() if self.last_visit else None,
+            self.active,
+            config.benefit_type
+        )
+        return dict(zip(_CUSTOMER_KEYS, values))
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
-    
+    __table_args__ = (
+        # Cobre o filtro e o ORDER BY created_at da listagem de transações
+        db.Index('ix_tx_customer_created', 'customer_id', 'created_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
@@ -139,7 +159,12 @@ class Transaction(db.Model):
     benefit_type = db.Column(db.String(20), default='points')  # Tipo de benefício aplicado
     description = db.Column(db.String(200), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
+
+    @cached_property
+    def created_at_iso(self):
+        """created_at em ISO-8601; imutável após o registro, formatado uma vez"""
+        return self.created_at.isoformat() if self.created_at else None
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -149,12 +174,16 @@ class Transaction(db.Model):
             'benefit_value': self.benefit_value,
             'benefit_type': self.benefit_type,
             'description': self.description,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': self.created_at_iso
         }
 
 class LoyaltyConfig(db.Model):
     __tablename__ = 'loyalty_config'
-    
+
+    # Níveis em ordem crescente de pontos; casa posição a posição com a tupla
+    # de thresholds usada no bisect
+    LEVELS = ('Bronze', 'Prata', 'Ouro', 'Diamante')
+
     id = db.Column(db.Integer, primary_key=True)
     benefit_type = db.Column(db.String(20), default='points')  # 'points', 'discount', 'cashback'
     points_per_real = db.Column(db.Float, default=10.0)  # Quantos reais para ganhar 1 ponto
@@ -178,9 +207,18 @@ class LoyaltyConfig(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     active = db.Column(db.Boolean, default=True)
     
+    # Cache em memória da configuração ativa: a tabela só muda via PUT /config,
+    # então um TTL curto evita um SELECT em praticamente todas as requisições
+    _config_cache = {'value': None, 'ts': 0.0}
+    _CACHE_TTL = 30.0  # segundos
+
     @staticmethod
-    def get_current_config():
-        """Retorna a configuração ativa atual"""
+    def load_active_config():
+        """Carrega (ou cria) a configuração ativa presa à sessão atual.
+
+        Use esta variante para escrever na configuração; para leitura prefira
+        get_current_config, que serve um snapshot em cache.
+        """
         config = LoyaltyConfig.query.filter_by(active=True).first()
         if not config:
             # Cria configuração padrão se não existir
@@ -188,6 +226,71 @@ class LoyaltyConfig(db.Model):
             db.session.add(config)
             db.session.commit()
         return config
+
+    @staticmethod
+    def get_current_config():
+        """Retorna a configuração ativa atual (snapshot com cache em memória)"""
+        cache = LoyaltyConfig._config_cache
+        if cache['value'] is not None and time.monotonic() - cache['ts'] < LoyaltyConfig._CACHE_TTL:
+            return cache['value']
+
+        config = LoyaltyConfig.load_active_config()
+        # Desacopla o snapshot da sessão com os atributos já carregados: um
+        # rollback/expire em outra requisição não pode mais invalidá-lo
+        db.session.refresh(config)
+        db.session.expunge(config)
+
+        cache['value'] = config
+        cache['ts'] = time.monotonic()
+        return config
+
+    @staticmethod
+    def invalidate_cache():
+        """Descarta a configuração em cache (chamar após alterá-la no banco)"""
+        LoyaltyConfig._config_cache['value'] = None
+
+    def _level_thresholds(self):
+        """Tupla (prata, ouro, diamante) cacheada na instância para o bisect"""
+        thresholds = self.__dict__.get('_thresholds')
+        if thresholds is None:
+            thresholds = (self.silver_threshold, self.gold_threshold, self.diamond_threshold)
+            self.__dict__['_thresholds'] = thresholds
+        return thresholds
+
+    def level_for_points(self, points):
+        """Nível correspondente à pontuação (busca binária nos thresholds)"""
+        return self.LEVELS[bisect_right(self._level_thresholds(), points)]
+
+    def points_to_next(self, points):
+        """Pontos que faltam para o próximo nível (0 se já for Diamante)"""
+        thresholds = self._level_thresholds()
+        idx = bisect_right(thresholds, points)
+        return 0 if idx == len(thresholds) else thresholds[idx] - points
+
+    def _compiled_promotion_template(self):
+        """Template de promoção pré-analisado (segmentos do string.Formatter)"""
+        tpl = self.promotion_message_template
+        cached = self.__dict__.get('_promotion_tpl')
+        if cached is None or cached[0] != tpl:
+            cached = (tpl, tuple(string.Formatter().parse(tpl)))
+            self.__dict__['_promotion_tpl'] = cached
+        return cached[1]
+
+    def format_promotion(self, name, points):
+        """Renderiza a mensagem de promoção sem reanalisar o template a cada envio"""
+        values = {'name': name, 'points': points}
+        parts = []
+        for literal, field, spec, conversion in self._compiled_promotion_template():
+            if literal:
+                parts.append(literal)
+            if field is not None:
+                value = values.get(field, '')
+                if conversion == 's':
+                    value = str(value)
+                elif conversion == 'r':
+                    value = repr(value)
+                parts.append(format(value, spec))
+        return ''.join(parts)
     
     def to_dict(self):
         return {
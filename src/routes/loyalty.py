@@ -1,65 +1,130 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from src.models.user import db
-from src.models.loyalty import Customer, Transaction, LoyaltyConfig, MenuItem, SiteContent
-import re
+from src.models.loyalty import Customer, Transaction, LoyaltyConfig, MenuItem, SiteContent, strip_non_digits
 from datetime import datetime
 
 loyalty_bp = Blueprint('loyalty', __name__)
 
+# Cache do conteúdo do site: tabela pequena, muito lida e raramente escrita;
+# invalidado no PUT /content
+_content_cache = {'dict': None}
+
+# orjson serializa JSON em código nativo, bem mais rápido que o json da stdlib
+# para as respostas grandes de listagem; sem ele vale o jsonify normal
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def ojsonify(payload):
+    """jsonify acelerado por orjson quando o pacote está instalado"""
+    if orjson is None:
+        return jsonify(payload)
+    return current_app.response_class(orjson.dumps(payload), mimetype='application/json')
+
+# Pesos dos dois dígitos verificadores, pré-computados uma única vez
+_CPF_W1 = (10, 9, 8, 7, 6, 5, 4, 3, 2)
+_CPF_W2 = (11, 10, 9, 8, 7, 6, 5, 4, 3, 2)
+
+# O checksum é um kernel numérico puro: quando o numba está instalado ele é
+# JIT-compilado para código de máquina; sem numba vale o fallback equivalente
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True)
+    def _cpf_checksum(buf):
+        sum1 = 0
+        for i in range(9):
+            sum1 += (buf[i] - 48) * (10 - i)
+        digit1 = 11 - sum1 % 11
+        if digit1 >= 10:
+            digit1 = 0
+
+        sum2 = 0
+        for i in range(10):
+            sum2 += (buf[i] - 48) * (11 - i)
+        digit2 = 11 - sum2 % 11
+        if digit2 >= 10:
+            digit2 = 0
+
+        return buf[9] - 48 == digit1 and buf[10] - 48 == digit2
+else:
+    def _cpf_checksum(buf):
+        # Converte os bytes para valores numéricos de uma vez (byte - 48 == dígito)
+        digits = [b - 48 for b in buf]
+
+        # Calcula primeiro dígito verificador
+        sum1 = sum(map(int.__mul__, digits, _CPF_W1))
+        digit1 = 11 - (sum1 % 11)
+        if digit1 >= 10:
+            digit1 = 0
+
+        # Calcula segundo dígito verificador
+        sum2 = sum(map(int.__mul__, digits, _CPF_W2))
+        digit2 = 11 - (sum2 % 11)
+        if digit2 >= 10:
+            digit2 = 0
+
+        return digits[9] == digit1 and digits[10] == digit2
+
 def validate_cpf(cpf):
     """Valida CPF brasileiro"""
-    cpf = re.sub(r'\D', '', cpf)
+    cpf = strip_non_digits(cpf)
     if len(cpf) != 11:
         return False
-    
-    # Verifica se todos os dígitos são iguais
-    if cpf == cpf[0] * 11:
+
+    # Verifica se todos os dígitos são iguais (str.count é um loop em C e não
+    # aloca a string descartável que cpf[0] * 11 criava)
+    if cpf.count(cpf[0]) == 11:
         return False
-    
-    # Calcula primeiro dígito verificador
-    sum1 = sum(int(cpf[i]) * (10 - i) for i in range(9))
-    digit1 = 11 - (sum1 % 11)
-    if digit1 >= 10:
-        digit1 = 0
-    
-    # Calcula segundo dígito verificador
-    sum2 = sum(int(cpf[i]) * (11 - i) for i in range(10))
-    digit2 = 11 - (sum2 % 11)
-    if digit2 >= 10:
-        digit2 = 0
-    
-    return cpf[-2:] == f"{digit1}{digit2}"
+
+    return _cpf_checksum(cpf.encode())
 
 @loyalty_bp.route('/customers', methods=['GET'])
 def get_customers():
     """Lista todos os clientes"""
     try:
         search = request.args.get('search', '')
-        page = int(request.args.get('page', 1))
+        # Normaliza entradas fora de faixa como o paginate() fazia: página
+        # mínima 1 e per_page de volta ao padrão (0 dividiria por zero no
+        # cálculo de páginas e valores negativos virariam LIMIT ilimitado)
+        page = max(int(request.args.get('page', 1)), 1)
         per_page = int(request.args.get('per_page', 10))
-        
+        if per_page < 1:
+            per_page = 10
+
         query = Customer.query.filter(Customer.active == True)
         
         if search:
             search_filter = f"%{search}%"
+            # Um único predicado sobre a concatenação das três colunas: uma
+            # avaliação por linha em vez de três ORs, e a mesma expressão pode
+            # ganhar um índice trigram (pg_trgm GIN) quando rodar em PostgreSQL
             query = query.filter(
-                db.or_(
-                    Customer.full_name.ilike(search_filter),
-                    Customer.cpf.like(search_filter),
-                    Customer.phone.like(search_filter)
-                )
+                (Customer.full_name + ' ' + Customer.cpf + ' ' + Customer.phone).ilike(search_filter)
             )
         
-        customers = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
+        # Uma consulta para o total e uma para a página (limit/offset com ordem
+        # determinística), sem o overhead extra do paginate()
+        total = query.count()
+        customers = (
+            query.order_by(Customer.id)
+            .limit(per_page)
+            .offset((page - 1) * per_page)
+            .all()
         )
-        
-        return jsonify({
-            'customers': [customer.to_dict() for customer in customers.items],
-            'total': customers.total,
-            'pages': customers.pages,
+
+        # Busca a configuração uma única vez para a página inteira
+        config = LoyaltyConfig.get_current_config()
+
+        return ojsonify({
+            'customers': [customer.to_dict(_config=config) for customer in customers],
+            'total': total,
+            'pages': (total + per_page - 1) // per_page,
             'current_page': page
         })
     except Exception as e:
@@ -82,7 +147,7 @@ def create_customer():
             return jsonify({'error': 'Telefone é obrigatório'}), 400
         
         # Limpa e valida CPF
-        cpf = re.sub(r'\D', '', data['cpf'])
+        cpf = strip_non_digits(data['cpf'])
         if not validate_cpf(cpf):
             return jsonify({'error': 'CPF inválido'}), 400
         
@@ -92,7 +157,7 @@ def create_customer():
             return jsonify({'error': 'CPF já cadastrado'}), 400
         
         # Limpa telefone
-        phone = re.sub(r'\D', '', data['phone'])
+        phone = strip_non_digits(data['phone'])
         
         customer = Customer(
             full_name=data['full_name'],
@@ -115,7 +180,8 @@ def get_customer(customer_id):
     """Busca um cliente específico"""
     try:
         customer = Customer.query.get_or_404(customer_id)
-        return jsonify(customer.to_dict())
+        config = LoyaltyConfig.get_current_config()
+        return jsonify(customer.to_dict(_config=config))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -130,7 +196,7 @@ def update_customer(customer_id):
             customer.full_name = data['full_name']
         
         if 'phone' in data:
-            customer.phone = re.sub(r'\D', '', data['phone'])
+            customer.phone = strip_non_digits(data['phone'])
         
         if 'email' in data:
             customer.email = data['email']
@@ -149,13 +215,40 @@ def update_customer(customer_id):
 def get_customer_by_cpf(cpf):
     """Busca cliente por CPF"""
     try:
-        cpf_clean = re.sub(r'\D', '', cpf)
-        customer = Customer.query.filter_by(cpf=cpf_clean).first()
-        
+        cpf_clean = strip_non_digits(cpf)
+
+        # Lookup mais quente da API (quiosque): carrega só as colunas que a
+        # resposta usa, aproveitando o índice único de cpf
+        customer = (
+            Customer.query.options(
+                db.load_only(
+                    Customer.id, Customer.full_name, Customer.cpf,
+                    Customer.phone, Customer.points, Customer.level,
+                    Customer.active
+                )
+            )
+            .filter_by(cpf=cpf_clean)
+            .first()
+        )
+
         if not customer:
             return jsonify({'error': 'Cliente não encontrado'}), 404
-        
-        return jsonify(customer.to_dict())
+
+        config = LoyaltyConfig.get_current_config()
+        return jsonify({
+            'id': customer.id,
+            'full_name': customer.full_name,
+            'cpf': customer.format_cpf(),
+            'cpf_raw': customer.cpf,
+            'phone': customer.format_phone(),
+            'phone_raw': customer.phone,
+            'points': customer.points,
+            'level': customer.level,
+            'discount': customer.get_discount(_config=config),
+            'points_to_next_level': customer.points_to_next_level(_config=config),
+            'active': customer.active,
+            'benefit_type': config.benefit_type
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -170,12 +263,45 @@ def add_transaction(customer_id):
         if amount <= 0:
             return jsonify({'error': 'Valor deve ser maior que zero'}), 400
         
-        # Calcula pontos ganhos
-        points_earned = customer.add_points(amount)
-        
-        # Calcula valor do benefício
+        # Busca a configuração uma única vez para toda a transação
         config = LoyaltyConfig.get_current_config()
-        benefit_value = customer.calculate_benefit_value(amount)
+
+        # Calcula pontos ganhos
+        points_earned = int(amount // config.points_per_real)
+
+        # Aplica pontos, total gasto e nível em um único UPDATE no servidor:
+        # sem o ciclo ler-modificar-gravar não há lost update sob concorrência,
+        # e some o crédito duplicado de pontos que add_points +
+        # calculate_benefit_value causavam no modo 'points'
+        level_expr = db.case(
+            (Customer.points + points_earned >= config.diamond_threshold, 'Diamante'),
+            (Customer.points + points_earned >= config.gold_threshold, 'Ouro'),
+            (Customer.points + points_earned >= config.silver_threshold, 'Prata'),
+            else_='Bronze'
+        )
+        new_level = db.session.execute(
+            db.update(Customer)
+            .where(Customer.id == customer_id)
+            .values(
+                points=Customer.points + points_earned,
+                total_spent=Customer.total_spent + amount,
+                level=level_expr,
+                last_visit=datetime.utcnow()
+            )
+            .returning(Customer.level)
+        ).scalar_one()
+
+        # Calcula valor do benefício sobre o nível já atualizado
+        if config.benefit_type in ('discount', 'cashback'):
+            discounts = {
+                'Bronze': config.bronze_discount,
+                'Prata': config.silver_discount,
+                'Ouro': config.gold_discount,
+                'Diamante': config.diamond_discount
+            }
+            benefit_value = amount * (discounts.get(new_level, config.bronze_discount) / 100)
+        else:  # points
+            benefit_value = points_earned
         
         # Cria transação
         transaction = Transaction(
@@ -189,10 +315,10 @@ def add_transaction(customer_id):
         
         db.session.add(transaction)
         db.session.commit()
-        
+
         return jsonify({
             'transaction': transaction.to_dict(),
-            'customer': customer.to_dict()
+            'customer': customer.to_dict(_config=config)
         }), 201
     except Exception as e:
         db.session.rollback()
@@ -202,12 +328,32 @@ def add_transaction(customer_id):
 def get_customer_transactions(customer_id):
     """Lista transações de um cliente"""
     try:
+        # Mesma normalização da listagem de clientes: página mínima 1 e
+        # per_page de volta ao padrão quando fora de faixa
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = int(request.args.get('per_page', 10))
+        if per_page < 1:
+            per_page = 10
+
         customer = Customer.query.get_or_404(customer_id)
-        transactions = Transaction.query.filter_by(customer_id=customer_id).order_by(Transaction.created_at.desc()).all()
-        
-        return jsonify({
+
+        # Página limitada em vez de materializar o histórico inteiro; o índice
+        # composto (customer_id, created_at) cobre o filtro e a ordenação
+        query = Transaction.query.filter_by(customer_id=customer_id)
+        total = query.count()
+        transactions = (
+            query.order_by(Transaction.created_at.desc())
+            .limit(per_page)
+            .offset((page - 1) * per_page)
+            .all()
+        )
+
+        return ojsonify({
             'customer': customer.to_dict(),
-            'transactions': [t.to_dict() for t in transactions]
+            'transactions': [t.to_dict() for t in transactions],
+            'total': total,
+            'pages': (total + per_page - 1) // per_page,
+            'current_page': page
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -225,7 +371,8 @@ def get_loyalty_config():
 def update_loyalty_config():
     """Atualiza configuração do programa de fidelidade"""
     try:
-        config = LoyaltyConfig.get_current_config()
+        # Ignora o cache: precisamos da instância presa à sessão atual para gravar
+        config = LoyaltyConfig.load_active_config()
         data = request.get_json()
         
         # Atualiza campos permitidos
@@ -241,7 +388,8 @@ def update_loyalty_config():
         
         config.updated_at = datetime.utcnow()
         db.session.commit()
-        
+        LoyaltyConfig.invalidate_cache()
+
         return jsonify(config.to_dict())
     except Exception as e:
         db.session.rollback()
@@ -258,7 +406,7 @@ def get_menu():
             query = query.filter(MenuItem.category == category)
         
         items = query.order_by(MenuItem.category, MenuItem.name).all()
-        return jsonify([item.to_dict() for item in items])
+        return ojsonify([item.to_dict() for item in items])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -290,8 +438,10 @@ def create_menu_item():
 def get_site_content():
     """Lista conteúdo do site"""
     try:
-        content = SiteContent.query.all()
-        return jsonify({item.key: item.value for item in content})
+        if _content_cache['dict'] is None:
+            content = SiteContent.query.all()
+            _content_cache['dict'] = {item.key: item.value for item in content}
+        return jsonify(_content_cache['dict'])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -300,17 +450,21 @@ def update_site_content():
     """Atualiza conteúdo do site"""
     try:
         data = request.get_json()
-        
-        for key, value in data.items():
-            content = SiteContent.query.filter_by(key=key).first()
-            if content:
-                content.value = value
-                content.updated_at = datetime.utcnow()
-            else:
-                content = SiteContent(key=key, value=value)
-                db.session.add(content)
-        
+
+        if data:
+            # Um único INSERT ... ON CONFLICT(key) DO UPDATE para o payload
+            # inteiro, em vez de um SELECT + UPDATE/INSERT por chave
+            stmt = sqlite_insert(SiteContent).values(
+                [{'key': key, 'value': value} for key, value in data.items()]
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={'value': stmt.excluded.value, 'updated_at': datetime.utcnow()}
+            )
+            db.session.execute(stmt)
+
         db.session.commit()
+        _content_cache['dict'] = None
         return jsonify({'message': 'Conteúdo atualizado com sucesso'})
     except Exception as e:
         db.session.rollback()
@@ -320,27 +474,45 @@ def update_site_content():
 def get_stats():
     """Retorna estatísticas do programa de fidelidade"""
     try:
-        total_customers = Customer.query.filter(Customer.active == True).count()
-        total_transactions = Transaction.query.count()
-        total_revenue = db.session.query(db.func.sum(Transaction.amount)).scalar() or 0
-        total_points = db.session.query(db.func.sum(Customer.points)).scalar() or 0
-        
-        # Clientes por nível
-        bronze = Customer.query.filter(Customer.level == 'Bronze', Customer.active == True).count()
-        silver = Customer.query.filter(Customer.level == 'Prata', Customer.active == True).count()
-        gold = Customer.query.filter(Customer.level == 'Ouro', Customer.active == True).count()
-        diamond = Customer.query.filter(Customer.level == 'Diamante', Customer.active == True).count()
-        
+        # Totais de clientes em uma única consulta (COUNT ... FILTER + SUM)
+        total_customers, total_points = db.session.query(
+            db.func.count(Customer.id).filter(Customer.active == True),
+            db.func.coalesce(db.func.sum(Customer.points), 0)
+        ).one()
+
+        # Totais de transações em uma única consulta
+        total_transactions, total_revenue = db.session.query(
+            db.func.count(Transaction.id),
+            db.func.coalesce(db.func.sum(Transaction.amount), 0)
+        ).one()
+
+        # Clientes ativos por nível em um único GROUP BY. O nível é derivado dos
+        # pontos com os thresholds atuais, em vez da coluna materializada
+        # 'level', que pode ficar defasada quando a configuração muda
+        config = LoyaltyConfig.get_current_config()
+        level_expr = db.case(
+            (Customer.points >= config.diamond_threshold, 'Diamante'),
+            (Customer.points >= config.gold_threshold, 'Ouro'),
+            (Customer.points >= config.silver_threshold, 'Prata'),
+            else_='Bronze'
+        )
+        by_level = dict(
+            db.session.query(level_expr, db.func.count(Customer.id))
+            .filter(Customer.active == True)
+            .group_by(level_expr)
+            .all()
+        )
+
         return jsonify({
             'total_customers': total_customers,
             'total_transactions': total_transactions,
             'total_revenue': total_revenue,
             'total_points': total_points,
             'customers_by_level': {
-                'Bronze': bronze,
-                'Prata': silver,
-                'Ouro': gold,
-                'Diamante': diamond
+                'Bronze': by_level.get('Bronze', 0),
+                'Prata': by_level.get('Prata', 0),
+                'Ouro': by_level.get('Ouro', 0),
+                'Diamante': by_level.get('Diamante', 0)
             }
         })
     except Exception as e: